@@ -1,4 +1,5 @@
 import sessen, os, urllib.parse, re, time, json, datetime
+import fetcher
 
 MAX_CACHE_SIZE = 3000
 IMG_EXTS = ['jpg', 'jpeg', 'gif', 'png', 'webp']
@@ -133,7 +134,13 @@ class Feed(object):
         api_url = api_url + '.json'
 
     # Query the api
-    js = sessen.webrequest('GET', api_url).json()
+    try:
+      js = fetcher.webrequest('GET', api_url).json()
+    except fetcher.HTTPStatusError as ex:
+      # Private subs come back as a 403 with the reason in the body
+      if ex.response.status != 403:
+        raise
+      js = ex.response.json()
 
     # Setup args
     has_max_score = 'max_score' in args
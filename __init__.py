@@ -1,30 +1,126 @@
-import hashlib, time, threading, email.utils, html, os, json, urllib.parse
+import hashlib, time, threading, queue, functools, os, json, urllib.parse
 import sessen, multithreaded_sqlite
-import feed_parser, html_sanitizer
+
+# Feed parsing, sanitizing, deduplication and fetching are imported where
+# they're used since most timer wake-ups don't need to update any feeds
 
 MAX_ITEMS_PER_PAGE = 100
 NUMBER_OF_FAILED_UPDATES_TO_LOG_AT = 3
 DELAY_BETWEEN_FEED_UPDATES = 80*60
 
-app_html = sessen.get_file('app.htm')
 config = json.loads(sessen.get_file('config.json'))
+logger = sessen.getLogger()
+
+# When set, parsing and sanitizing during scheduled updates run in a pool of
+# this many processes rather than in the feed worker thread
+INGESTION_PROCESSES = int(config.get('ingestion_processes', 0))
+
+# Either 'read' to store items already seen through another feed as read,
+# sharing the original's body, or 'skip' to not store them at all
+DEDUP_MODE = config.get('dedup_items')
+if DEDUP_MODE not in (None, 'read', 'skip'):
+  logger.error('Unknown dedup_items setting ' + repr(DEDUP_MODE) + ", expected 'read' or 'skip' - deduplication is off")
+  DEDUP_MODE = None
 
 database = multithreaded_sqlite.connect(os.path.join(os.path.dirname(__file__), 'subscriptions.db'), timeout=60)
 persistent = sessen.PersistentDatastore()
 dstore = sessen.ExtensionDatastore()
 
+# Duplicates share the description of the item they duplicate
+DESCRIPTION_COLUMN = 'COALESCE(description, (SELECT o.description FROM items o WHERE o.guid=items.duplicate_of))'
+ITEM_COLUMNS = 'items.guid, title, link, ' + DESCRIPTION_COLUMN + ', pubdate, read, subscription'
+SUMMARY_COLUMNS = 'items.guid, title, link, excerpt, pubdate, read, subscription'
+SUMMARY_TABLES = 'items LEFT JOIN excerpts ON excerpts.guid=items.guid'
+
+# Bumped whenever init_db learns a new migration so that starts with an up
+# to date database only have to read user_version
+SCHEMA_VERSION = 1
+BACKFILL_BATCH_SIZE = 500
+
 def init_db(db):
+  if db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+    return
   db.execute('create table if not exists subscriptions (title TEXT, link TEXT, url TEXT PRIMARY KEY, category TEXT)')
-  db.execute('create table if not exists items (guid BLOB PRIMARY KEY, title TEXT, link TEXT, description TEXT, pubdate REAL, read INTEGER, subscription INTEGER)')
+  db.execute('create table if not exists items (guid BLOB PRIMARY KEY, title TEXT, link TEXT, description TEXT, pubdate REAL, read INTEGER, subscription INTEGER, duplicate_of BLOB)')
+  # Paging goes through this index and excerpts live in their own table so
+  # listing summaries never has to step through a description's overflow pages
+  db.execute('create index if not exists items_by_page on items (subscription, read, pubdate)')
+  has_excerpts = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='excerpts'").fetchone()
+  db.execute('create table if not exists excerpts (guid BLOB PRIMARY KEY, excerpt TEXT) WITHOUT ROWID')
+  columns = [i[1] for i in db.execute('PRAGMA table_info(items)').fetchall()]
+  if 'duplicate_of' not in columns:
+    db.execute('ALTER TABLE items ADD COLUMN duplicate_of BLOB')
+    db.commit()
+  if not has_excerpts:
+    # Databases from before summaries existed need their excerpts backfilled once
+    # Descriptions are streamed in batches rather than all loaded at once,
+    # inserts go through their own cursor so they don't reset the read
+    import ingest
+    rows = db.execute('SELECT guid, ' + DESCRIPTION_COLUMN + ' FROM items')
+    insert = db.cursor()
+    while True:
+      batch = rows.fetchmany(BACKFILL_BATCH_SIZE)
+      if not batch:
+        break
+      insert.executemany('INSERT OR IGNORE INTO excerpts VALUES (?,?)',
+                         [(guid, ingest.make_excerpt(description or '')) for guid, description in batch])
+    insert.close()
+  db.execute('PRAGMA user_version = ' + str(SCHEMA_VERSION))
+  db.commit()
 database.run(init_db)
 
-logger = sessen.getLogger()
+SUBEXTENSION_MANIFEST = 'manifest.json'
+
+def get_fetcher():
+  import fetcher
+  global _fetcher_configured
+  if not _fetcher_configured:
+    f = fetcher.default_fetcher
+    f.max_body_size = int(config.get('max_feed_size', fetcher.MAX_BODY_SIZE))
+    f.connect_timeout = float(config.get('feed_connect_timeout', fetcher.CONNECT_TIMEOUT))
+    f.download_timeout = float(config.get('feed_download_timeout', fetcher.DOWNLOAD_TIMEOUT))
+    f.max_connections_per_host = int(config.get('max_connections_per_host', fetcher.MAX_CONNECTIONS_PER_HOST))
+    _fetcher_configured = True
+  return fetcher
+_fetcher_configured = False
 
 subextension_feeds = {}
+_loaded_subextensions = {}
+_subextension_lock = threading.Lock()
+def load_subextension(name):
+  # Subextensions fetch through the shared fetcher so it has to be configured first
+  get_fetcher()
+  with _subextension_lock:
+    if name not in _loaded_subextensions:
+      e = sessen.load_subextension(os.path.join('Extensions',name))
+      feeds = {f.id:f for f in e.feeds}
+      subextension_feeds.update(feeds)
+      _loaded_subextensions[name] = feeds
+    return _loaded_subextensions[name]
+
+class LazySubextensionFeed(object):
+  # Stands in for a feed listed in the manifest until the first time it's fetched
+  def __init__(self, name, id):
+    self.name = name
+    self.id = id
+
+  def get(self, args):
+    return load_subextension(self.name)[self.id].get(args)
+
+try:
+  subextension_manifest = json.loads(sessen.get_file(os.path.join('Extensions', SUBEXTENSION_MANIFEST)))
+except FileNotFoundError:
+  subextension_manifest = {}
+
 for e in sessen.listdir('Extensions'):
-  e = sessen.load_subextension(os.path.join('Extensions',e))
-  for f in e.feeds:
-    subextension_feeds[f.id] = f
+  if e == SUBEXTENSION_MANIFEST:
+    continue
+  if e in subextension_manifest:
+    for id in subextension_manifest[e]:
+      subextension_feeds[id] = LazySubextensionFeed(e, id)
+  else:
+    # Anything missing from the manifest has to be loaded to find its feed ids
+    load_subextension(e)
 
 def sha1(s):
   try:
@@ -36,71 +132,83 @@ def make_subscription_dict(tup):
   keys = ('rowid', 'title', 'link', 'url', 'category')
   return {keys[i]:tup[i] for i in range(len(tup))}
 
-def make_item_dict(tup):
-  keys = ('guid', 'title', 'link', 'description', 'pubdate', 'read', 'subscription_rowid')
+def make_item_dict(tup, summary=False):
+  keys = ('guid', 'title', 'link', 'excerpt' if summary else 'description', 'pubdate', 'read', 'subscription_rowid')
   return {keys[i]:(tup[i] if keys[i]!='guid' else tup[i].hex()) for i in range(len(tup))}
 
-def get_feed(url):
+def fetch_feed(url):
+  # Returns a parsed feed for subextension feeds, otherwise the raw feed text
   p = urllib.parse.urlparse(url)
   if p.path in subextension_feeds:
-    feed = subextension_feeds[p.path].get(urllib.parse.parse_qs(p.query))
-  else:
-    r = sessen.webrequest('GET', url)
-    feed = feed_parser.parse(r.text())
+    return subextension_feeds[p.path].get(urllib.parse.parse_qs(p.query))
+  r = get_fetcher().webrequest('GET', url)
+  return r.text()
+
+def get_feed(url):
+  feed = fetch_feed(url)
+  if not isinstance(feed, dict):
+    import feed_parser
+    feed = feed_parser.parse(feed)
   feed['url'] = url
   return feed
 
-def update_feed_items(subscription, feed):
-  items = []
-  for item in feed['items']:
-    link = html.unescape(item['link'])
-    title = html_sanitizer.sanitize(item['title'], link)
-    guid = sha1(sha1(subscription['url'])+sha1(item['guid']))
-    description = html_sanitizer.sanitize(item['description'], link)
-    try:
-      pubdate = time.mktime(email.utils.parsedate(item['pubdate']))
-    except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
-      try:
-        pubdate = time.mktime(time.strptime(item['updated'], '%Y-%m-%dT%H:%M:%S%z'))
-      except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
-        if 'pubdate' in item and type(item['pubdate']) is float:
-          pubdate = item['pubdate']
-        elif 'pubdate' in item and type(item['pubdate']) is int:
-          pubdate = float(item['pubdate'])
-        else:
-          pubdate = time.time()
-    read = False
-    subscription_rowid = subscription['rowid']
-    items.append((guid, item['title'], link, description, pubdate, read, subscription_rowid))
+def write_feed_items(subscription, items):
   def f(db):
     res = db.execute('SELECT * FROM subscriptions WHERE ROWID=(?) and url=(?)', (subscription['rowid'], subscription['url'])).fetchone()
     if not res:
       # The feed was deleted between when the update was requested and when it completed
       # Ignore the the new items
       return
+    if DEDUP_MODE:
+      import dedup
+      dedup.init_db(db)
     for item in items:
-      db.execute('INSERT OR IGNORE INTO items VALUES (?,?,?,?,?,?,?)', item)
+      if DEDUP_MODE:
+        item, fp = item[:-1], item[-1]
+        if db.execute('SELECT 1 FROM items WHERE guid=(?)', (item[0],)).fetchone():
+          continue
+        original = dedup.find_original(db, fp, subscription['rowid'])
+        if original:
+          if DEDUP_MODE == 'skip':
+            continue
+          guid, title, link, description, pubdate, read, subscription_rowid, excerpt = item
+          db.execute('INSERT INTO items (guid, title, link, description, pubdate, read, subscription, duplicate_of) VALUES (?,?,?,?,?,?,?,?)',
+                     (guid, title, link, None, pubdate, True, subscription_rowid, original))
+          db.execute('INSERT OR IGNORE INTO excerpts VALUES (?,?)', (guid, excerpt))
+          continue
+        dedup.add_fingerprint(db, item[0], subscription['rowid'], fp)
+      db.execute('INSERT OR IGNORE INTO items (guid, title, link, description, pubdate, read, subscription) VALUES (?,?,?,?,?,?,?)', item[:7])
+      db.execute('INSERT OR IGNORE INTO excerpts VALUES (?,?)', (item[0], item[7]))
     db.commit()
   database.run(f)
 
+def update_feed_items(subscription, feed):
+  import ingest
+  write_feed_items(subscription, ingest.prepare_items(subscription, feed, bool(DEDUP_MODE)))
+
 _failed_update_count = {}
+def record_update_success(subscription):
+  _failed_update_count.pop(subscription['url'], None)
+
+def record_update_failure(subscription, ex):
+  import traceback
+  url = subscription['url']
+  logger.info('dbg failure ' + url + time.strftime(' %c ') + traceback.format_exc())
+  count = _failed_update_count.get(url, 0) + 1
+  _failed_update_count[url] = count
+  if count == NUMBER_OF_FAILED_UPDATES_TO_LOG_AT:
+    try:
+      logger.error('Failed to update feed ' + str(count) + ' time(s) - ' + url + ' - ' + traceback.format_exc())
+    except:
+      logger.error('Failed to update feed ' + str(count) + ' time(s) - ' + url + ' - ' + repr(ex))
+
 def update_feed(subscription):
   try:
-    url = subscription['url']
-    feed = get_feed(url)
+    feed = get_feed(subscription['url'])
     update_feed_items(subscription, feed)
-    _failed_update_count.pop(url, None)
+    record_update_success(subscription)
   except Exception as ex:
-    import traceback
-    logger.info('dbg failure ' + url + time.strftime(' %c ') + traceback.format_exc())
-    count = _failed_update_count.get(url, 0) + 1
-    _failed_update_count[url] = count
-    if count == NUMBER_OF_FAILED_UPDATES_TO_LOG_AT:
-      try:
-        import traceback
-        logger.error('Failed to update feed ' + str(count) + ' time(s) - ' + subscription['url'] + ' - ' + traceback.format_exc())
-      except:
-        logger.error('Failed to update feed ' + str(count) + ' time(s) - ' + subscription['url'] + ' - ' + repr(ex))
+    record_update_failure(subscription, ex)
 
 def get_current_isp():
   import random, re
@@ -113,11 +221,77 @@ def get_current_isp():
   r = sessen.webrequest('GET', url)
   return re.findall(pattern, r.text())[0].strip()
 
+def write_worker(write_queue):
+  # The only thread which writes ingested items while a pooled update is running
+  while True:
+    job = write_queue.get()
+    if job is None:
+      return
+    subscription, items = job
+    try:
+      write_feed_items(subscription, items)
+      record_update_success(subscription)
+    except Exception as ex:
+      record_update_failure(subscription, ex)
+
+def update_feeds_in_pool(subscriptions):
+  # Fetching stays in this process since it needs sessen and is I/O bound,
+  # parsing and sanitizing run in worker processes so they don't hold the GIL
+  # the request handlers need and writes are funneled through one writer
+  # Feeds are fetched a batch at a time, one per worker, so that the workers
+  # actually have parses to overlap; the wait before each batch keeps the
+  # same average of one feed every 30 seconds as the serial update
+  import concurrent.futures, itertools, ingest
+  write_queue = queue.Queue()
+  writer = threading.Thread(target = write_worker, args = (write_queue,))
+  writer.start()
+
+  def on_done(subscription, future):
+    try:
+      write_queue.put((subscription, future.result()))
+    except Exception as ex:
+      record_update_failure(subscription, ex)
+
+  subscriptions = iter(subscriptions)
+  fetch_pool = concurrent.futures.ThreadPoolExecutor(INGESTION_PROCESSES)
+  pool = concurrent.futures.ProcessPoolExecutor(INGESTION_PROCESSES)
+  try:
+    while True:
+      batch = list(itertools.islice(subscriptions, INGESTION_PROCESSES))
+      if not batch:
+        break
+      time.sleep(30*len(batch))
+      fetches = [(subscription, fetch_pool.submit(fetch_feed, subscription['url'])) for subscription in batch]
+      for subscription, fetch in fetches:
+        try:
+          raw = fetch.result()
+          try:
+            future = pool.submit(ingest.prepare_items, subscription, raw, bool(DEDUP_MODE))
+          except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (OOM, a crash in the parser, etc) which breaks the
+            # whole pool; the feeds it had in flight get recorded as failures
+            # by on_done so start a fresh pool for the rest
+            pool.shutdown(wait=False)
+            pool = concurrent.futures.ProcessPoolExecutor(INGESTION_PROCESSES)
+            future = pool.submit(ingest.prepare_items, subscription, raw, bool(DEDUP_MODE))
+        except Exception as ex:
+          record_update_failure(subscription, ex)
+          continue
+        future.add_done_callback(functools.partial(on_done, subscription))
+  finally:
+    fetch_pool.shutdown()
+    pool.shutdown()
+    write_queue.put(None)
+    writer.join()
+
 def update_feeds():
   def f(db):
     cur = db.execute('SELECT ROWID,* FROM subscriptions ORDER BY RANDOM()')
     return cur.fetchall()
-  for subscription in map(make_subscription_dict, database.run(f)):
+  subscriptions = map(make_subscription_dict, database.run(f))
+  if INGESTION_PROCESSES > 0:
+    return update_feeds_in_pool(subscriptions)
+  for subscription in subscriptions:
     time.sleep(30)
     update_feed(subscription)
 
@@ -146,9 +320,13 @@ def update_feeds_worker():
     next_delay = DELAY_BETWEEN_FEED_UPDATES
     update_feeds()
 
+_app_html = None
 @sessen.bind('GET', '/?$')
 def main_page(connection):
-  connection.send_html(app_html)
+  global _app_html
+  if _app_html is None:
+    _app_html = sessen.get_file('app.htm')
+  connection.send_html(_app_html)
 
 def requires_login(func):
   def wrapper(connection, *args, **kwargs):
@@ -230,6 +408,12 @@ def delete_subscription(connection):
         cur = db.execute('BEGIN EXCLUSIVE')
         cur.execute('DELETE FROM subscriptions WHERE ROWID=(?) and url=(?)', (sub['rowid'], sub['url']))
         if cur.rowcount == 1:
+          import dedup
+          dedup.delete_subscription(db, sub['rowid'])
+          # Give duplicates in other feeds their own copy of bodies about to be deleted
+          cur.execute('UPDATE items SET description=(SELECT o.description FROM items o WHERE o.guid=items.duplicate_of), duplicate_of=NULL '
+                      'WHERE duplicate_of IN (SELECT guid FROM items WHERE subscription=(?))', (sub['rowid'],))
+          cur.execute('DELETE FROM excerpts WHERE guid IN (SELECT guid FROM items WHERE subscription=(?))', (sub['rowid'],))
           cur.execute('DELETE FROM items WHERE subscription=(?)', (sub['rowid'],))
       except Exception as ex:
         db.rollback()
@@ -242,7 +426,7 @@ def delete_subscription(connection):
   connection.send_json({})
 
 @requires_login
-def get_page(connection, read):
+def get_page(connection, read, summary=False):
   sub = get_sub_by_url_hash(connection.args['url_hash'])
   try:
     page_num = int(connection.args['page_num'])
@@ -251,10 +435,12 @@ def get_page(connection, read):
   offset = page_num * MAX_ITEMS_PER_PAGE
   if sub:
     subscription_rowid = sub['rowid']
+    columns = SUMMARY_COLUMNS if summary else ITEM_COLUMNS
+    tables = SUMMARY_TABLES if summary else 'items'
     def f(db):
-      cur = db.execute('SELECT * FROM items WHERE subscription=(?) AND read=(?) ORDER BY pubdate ASC LIMIT (?) OFFSET (?)',
+      cur = db.execute('SELECT ' + columns + ' FROM ' + tables + ' WHERE subscription=(?) AND read=(?) ORDER BY pubdate ASC LIMIT (?) OFFSET (?)',
                        (subscription_rowid, read, MAX_ITEMS_PER_PAGE, offset))
-      return [make_item_dict(i) for i in cur.fetchall()]
+      return [make_item_dict(i, summary) for i in cur.fetchall()]
     result = {'items': database.run(f)}
     connection.send_json({'result': result})
   else:
@@ -268,6 +454,27 @@ sessen.bind('GET',
             r'/subscriptions/(?P<url_hash>.+?)/unread/(?P<page_num>\d+)$',
             lambda connection: get_page(connection, False))
 
+sessen.bind('GET',
+            r'/subscriptions/(?P<url_hash>.+?)/read/(?P<page_num>\d+)/summaries$',
+            lambda connection: get_page(connection, True, True))
+
+sessen.bind('GET',
+            r'/subscriptions/(?P<url_hash>.+?)/unread/(?P<page_num>\d+)/summaries$',
+            lambda connection: get_page(connection, False, True))
+
+@sessen.bind('POST', '/items/descriptions$')
+@requires_login
+def get_item_descriptions(connection):
+  try:
+    guids = [bytes.fromhex(guid) for guid in connection.receive_json()]
+  except (ValueError, TypeError):
+    return connection.send_json({'error': 'Invalid items'})
+  guids = guids[:MAX_ITEMS_PER_PAGE]
+  def f(db):
+    cur = db.execute('SELECT guid, ' + DESCRIPTION_COLUMN + ' FROM items WHERE guid IN (' + ','.join('?'*len(guids)) + ')', guids)
+    return {guid.hex():description for guid, description in cur.fetchall()}
+  connection.send_json({'result': database.run(f) if guids else {}})
+
 @sessen.bind('PUT', '/items$')
 @requires_login
 def update_items(connection):
@@ -309,6 +516,11 @@ def refresh_subscription(connection):
   else:
     return connection.send_json({'error': 'Invalid subscription'})
 
+@sessen.bind('GET', '/fetch_stats$')
+@requires_login
+def get_fetch_stats(connection):
+  connection.send_json({'result': get_fetcher().stats()})
+
 @sessen.bind('POST', '/login$')
 def login(connection):
   try:
@@ -326,7 +538,13 @@ def logout(connection):
   persistent.delete_all(connection)
   connection.send_json({'error':None})
 
-feed_worker_thread = threading.Thread(target = update_feeds_worker)
+def feed_worker():
+  # Runs in the background rather than being joined at import so requests can
+  # be served while an update is in progress
+  try:
+    update_feeds_worker()
+  finally:
+    sessen.trigger_exit_when_idle()
+
+feed_worker_thread = threading.Thread(target = feed_worker)
 feed_worker_thread.start()
-feed_worker_thread.join()
-sessen.trigger_exit_when_idle()
@@ -0,0 +1,153 @@
+# Times a Readyr cold start: importing the extension the way Sessen does on
+# every timer wake-up, then serving the first request
+#
+# Sessen isn't needed, the extension is run against a minimal stand-in for
+# sessen and multithreaded_sqlite from a temporary copy of this directory.
+# Each start runs in a fresh interpreter, both with the subextension manifest
+# and without it (every subextension loaded eagerly, as before the manifest).
+#
+# Usage: python benchmarks/startup.py [runs]
+
+import json, os, shutil, statistics, subprocess, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COPIED = ['__init__.py', 'feed_parser.py', 'html_sanitizer.py', 'ingest.py',
+          'dedup.py', 'fetcher.py', 'app.htm', 'Extensions']
+
+SESSEN_STUB = r'''
+import importlib.util, logging, os, sys
+EXT_DIR = os.environ['READYR_BENCH_DIR']
+EAGER = os.environ['READYR_BENCH_MODE'] == 'eager'
+routes = []
+
+def get_file(path):
+  if EAGER and os.path.basename(path) == 'manifest.json':
+    raise FileNotFoundError(path)
+  with open(os.path.join(EXT_DIR, path), 'r') as f:
+    return f.read()
+
+def listdir(path):
+  return [i for i in os.listdir(os.path.join(EXT_DIR, path)) if not i.startswith('__')]
+
+def load_subextension(path):
+  name = 'subextension_' + os.path.splitext(os.path.basename(path))[0]
+  spec = importlib.util.spec_from_file_location(name, os.path.join(EXT_DIR, path))
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def bind(method, path, func=None):
+  if func:
+    routes.append((method, path, func))
+    return func
+  def decorator(func):
+    routes.append((method, path, func))
+    return func
+  return decorator
+
+def getLogger(name='Readyr'):
+  return logging.getLogger(name)
+
+class PersistentDatastore(object):
+  pass
+
+class ExtensionDatastore(dict):
+  pass
+
+class ExtensionProxy(object):
+  def __init__(self, name):
+    pass
+
+  def schedule_once(self, name, delay):
+    pass
+
+def get_name():
+  return 'Readyr'
+
+def trigger_exit_when_idle():
+  pass
+'''
+
+SQLITE_STUB = r'''
+import sqlite3, threading
+
+class Database(object):
+  def __init__(self, path, timeout):
+    self.db = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    self.lock = threading.Lock()
+
+  def run(self, f):
+    with self.lock:
+      return f(self.db)
+
+def connect(path, timeout=5):
+  return Database(path, timeout)
+'''
+
+RUNNER = r'''
+import time
+start = time.perf_counter()
+import importlib.util, json, os, sys
+ext_dir = os.environ['READYR_BENCH_DIR']
+spec = importlib.util.spec_from_file_location('readyr', os.path.join(ext_dir, '__init__.py'),
+                                              submodule_search_locations=[ext_dir])
+module = importlib.util.module_from_spec(spec)
+sys.modules['readyr'] = module
+spec.loader.exec_module(module)
+loaded = time.perf_counter()
+
+class Connection(object):
+  def send_html(self, htm):
+    pass
+
+import sessen
+main_page = [f for method, path, f in sessen.routes if path == '/?$'][0]
+main_page(Connection())
+served = time.perf_counter()
+module.feed_worker_thread.join()
+print(json.dumps({'init': loaded - start, 'first_request': served - start}))
+'''
+
+def run(work_dir, mode):
+  env = dict(os.environ, READYR_BENCH_DIR=os.path.join(work_dir, 'ext'), READYR_BENCH_MODE=mode,
+             PYTHONPATH=os.pathsep.join([os.path.join(work_dir, 'stubs'), os.path.join(work_dir, 'ext')]))
+  out = subprocess.run([sys.executable, '-c', RUNNER], env=env, cwd=work_dir,
+                       capture_output=True, text=True, check=True).stdout
+  return json.loads(out.splitlines()[-1])
+
+def setup(work_dir):
+  ext_dir = os.path.join(work_dir, 'ext')
+  os.makedirs(ext_dir)
+  for name in COPIED:
+    src = os.path.join(ROOT, name)
+    if os.path.isdir(src):
+      shutil.copytree(src, os.path.join(ext_dir, name), ignore=shutil.ignore_patterns('__pycache__'))
+    else:
+      shutil.copy(src, ext_dir)
+  with open(os.path.join(ext_dir, 'config.json'), 'w') as f:
+    f.write('{}')
+  os.makedirs(os.path.join(work_dir, 'stubs'))
+  with open(os.path.join(work_dir, 'stubs', 'sessen.py'), 'w') as f:
+    f.write(SESSEN_STUB)
+  with open(os.path.join(work_dir, 'stubs', 'multithreaded_sqlite.py'), 'w') as f:
+    f.write(SQLITE_STUB)
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+  with tempfile.TemporaryDirectory() as work_dir:
+    setup(work_dir)
+    results = {}
+    for mode in ('eager', 'manifest'):
+      # The first start creates the database and writes bytecode caches
+      run(work_dir, mode)
+      timings = [run(work_dir, mode) for _ in range(runs)]
+      results[mode] = {k: statistics.median(t[k] for t in timings) * 1000 for k in ('init', 'first_request')}
+  print('Median over ' + str(runs) + ' cold starts (ms)')
+  print('  %-28s %10s %10s' % ('', 'init', 'first req'))
+  for mode, label in (('eager', 'Subextensions loaded eagerly'), ('manifest', 'Loaded from the manifest')):
+    print('  %-28s %10.2f %10.2f' % (label, results[mode]['init'], results[mode]['first_request']))
+  print('  %-28s %10.2f %10.2f' % ('Saved', results['eager']['init'] - results['manifest']['init'],
+                                   results['eager']['first_request'] - results['manifest']['first_request']))
+
+if __name__ == '__main__':
+  main()
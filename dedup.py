@@ -0,0 +1,113 @@
+# Detects the same article showing up through more than one feed
+# Items are fingerprinted by their normalized link and a SimHash of their
+# text so near-duplicates (different tracking params, trimmed intros, etc)
+# still match. The SimHash is split into bands which are indexed separately;
+# any two hashes within MAX_DISTANCE bits of each other share at least one band
+
+import hashlib, re, urllib.parse
+
+SIMHASH_BITS = 64
+BANDS = 4
+BAND_BITS = SIMHASH_BITS // BANDS
+MAX_DISTANCE = BANDS - 1
+MIN_TOKENS = 20
+TRACKING_PARAMS = ('fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref', 'cmpid')
+TRACKING_PARAM_PREFIXES = ('utm_',)
+
+_db_initialized = False
+def init_db(db):
+  # Only called once something is actually being deduplicated so wake-ups
+  # with deduplication turned off never touch the fingerprints table
+  global _db_initialized
+  if _db_initialized:
+    return
+  db.execute('create table if not exists fingerprints (guid BLOB PRIMARY KEY, link_hash BLOB, simhash INTEGER, ' +
+             ', '.join('band'+str(i)+' INTEGER' for i in range(BANDS)) + ', subscription INTEGER)')
+  _db_initialized = True
+  db.execute('create index if not exists fingerprints_link_hash on fingerprints (link_hash)')
+  for i in range(BANDS):
+    db.execute('create index if not exists fingerprints_band'+str(i)+' on fingerprints (band'+str(i)+')')
+
+def normalize_link(link):
+  p = urllib.parse.urlsplit(link.strip())
+  netloc = p.netloc.lower()
+  if netloc.startswith('www.'):
+    netloc = netloc[4:]
+  query = [(k, v) for k, v in urllib.parse.parse_qsl(p.query, keep_blank_values=True)
+           if k.lower() not in TRACKING_PARAMS and not k.lower().startswith(TRACKING_PARAM_PREFIXES)]
+  path = p.path.rstrip('/') or '/'
+  return netloc + path + ('?' + urllib.parse.urlencode(sorted(query)) if query else '')
+
+def _hash64(s):
+  return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), 'big')
+
+def simhash(text):
+  tokens = re.findall(r'\w+', text.lower())
+  if len(tokens) < MIN_TOKENS:
+    # Too little text to say anything useful about near-duplicates
+    return None
+  weights = [0] * SIMHASH_BITS
+  for token in set(tokens):
+    h = _hash64(token)
+    for bit in range(SIMHASH_BITS):
+      weights[bit] += 1 if h & (1 << bit) else -1
+  return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+def fingerprint(link, description):
+  import html_sanitizer
+  link_hash = hashlib.sha1(normalize_link(link).encode()).digest() if link else None
+  return link_hash, simhash(html_sanitizer.to_text(description))
+
+def _to_signed(h):
+  # SQLite integers are signed 64 bit
+  return h - (1 << SIMHASH_BITS) if h >= (1 << (SIMHASH_BITS - 1)) else h
+
+def _bands(h):
+  if h is None:
+    return [None] * BANDS
+  return [(h >> (BAND_BITS*i)) & ((1 << BAND_BITS) - 1) for i in range(BANDS)]
+
+def find_original(db, fp, subscription_rowid):
+  # Returns the guid of an item from another subscription matching fp or None
+  # Matches within the same feed are left alone, plenty of feeds link every
+  # item to the same page or re-issue posts on purpose
+  link_hash, h = fp
+  conditions, params = [], []
+  if link_hash:
+    conditions.append('link_hash=(?)')
+    params.append(link_hash)
+  if h is not None:
+    for i, band in enumerate(_bands(h)):
+      conditions.append('band'+str(i)+'=(?)')
+      params.append(band)
+  if not conditions:
+    return None
+  cur = db.execute('SELECT guid, link_hash, simhash FROM fingerprints WHERE subscription!=(?) AND (' + ' OR '.join(conditions) + ')',
+                   [subscription_rowid] + params)
+  # The same link is a far stronger signal than similar text so it wins even
+  # when a SimHash match comes back first
+  near = None
+  for guid, other_link_hash, other in cur.fetchall():
+    if link_hash and other_link_hash == link_hash:
+      return guid
+    if near is None and h is not None and other is not None and bin((other ^ _to_signed(h)) & ((1 << SIMHASH_BITS) - 1)).count('1') <= MAX_DISTANCE:
+      near = guid
+  return near
+
+def delete_subscription(db, subscription_rowid):
+  # Runs inside the caller's transaction so mustn't commit or create anything,
+  # the table won't exist if deduplication has never been turned on
+  # Must run before duplicates are promoted so duplicate_of still says which
+  # items each fingerprint can be handed to, otherwise the next copy of the
+  # article from yet another feed wouldn't be recognized
+  if db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='fingerprints'").fetchone():
+    promoted = 'SELECT i.{} FROM items i WHERE i.duplicate_of=fingerprints.guid ORDER BY i.pubdate, i.guid LIMIT 1'
+    db.execute('UPDATE fingerprints SET guid=(' + promoted.format('guid') + '), subscription=(' + promoted.format('subscription') + ') '
+               'WHERE subscription=(?) AND EXISTS (SELECT 1 FROM items i WHERE i.duplicate_of=fingerprints.guid)', (subscription_rowid,))
+    db.execute('DELETE FROM fingerprints WHERE subscription=(?)', (subscription_rowid,))
+
+def add_fingerprint(db, guid, subscription_rowid, fp):
+  link_hash, h = fp
+  db.execute('INSERT OR REPLACE INTO fingerprints (guid, link_hash, simhash, ' +
+             ', '.join('band'+str(i) for i in range(BANDS)) + ', subscription) VALUES (?,?,?,' + ','.join('?'*BANDS) + ',?)',
+             [guid, link_hash, None if h is None else _to_signed(h)] + _bands(h) + [subscription_rowid])
@@ -0,0 +1,278 @@
+# A small HTTP/1.1 client for feed fetches
+# Connections are kept alive and pooled per host so the many feeds pulled
+# from the same sites don't each pay for a new TCP and TLS handshake
+
+import http.client, urllib.parse, threading, time, zlib, json, re, socket, codecs
+
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_BODY_SIZE = 16*1024*1024
+CONNECT_TIMEOUT = 30
+DOWNLOAD_TIMEOUT = 120
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64*1024
+USER_AGENT = 'Readyr'
+
+# Longest first, the UTF-32 LE BOM starts with the UTF-16 LE one
+BOMS = [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
+
+class FetchError(Exception):
+  pass
+
+class HTTPStatusError(FetchError):
+  # Raised for non-2xx responses, the response is kept since some APIs
+  # explain the error in the body
+  def __init__(self, response):
+    FetchError.__init__(self, 'HTTP ' + str(response.status) + ' from ' + response.url)
+    self.response = response
+
+class Response(object):
+  def __init__(self, url, status, headers, data):
+    self.url = url
+    self.status = status
+    self.headers = headers
+    self.data = data
+
+  def encoding(self):
+    # A BOM wins, then the Content-Type charset, then the XML declaration
+    # since plenty of feeds only declare their encoding in the prolog
+    for bom, encoding in BOMS:
+      if self.data.startswith(bom):
+        return encoding
+    m = re.search(r'(?i)charset\s*=\s*["\']?([\w.:-]+)', self.headers.get('Content-Type', ''))
+    if m:
+      return m.group(1)
+    m = re.match(rb'\s*<\?xml[^>]*?encoding\s*=\s*["\']([\w.:-]+)["\']', self.data)
+    if m:
+      return m.group(1).decode('ascii')
+    return 'utf-8'
+
+  def text(self):
+    try:
+      return self.data.decode(self.encoding(), 'replace')
+    except LookupError:
+      return self.data.decode('utf-8', 'replace')
+
+  def json(self):
+    return json.loads(self.text())
+
+def _make_decoder(encoding):
+  encoding = (encoding or '').strip().lower()
+  if encoding in ('gzip', 'x-gzip'):
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  elif encoding == 'deflate':
+    return _DeflateDecoder()
+  elif encoding in ('', 'identity'):
+    return None
+  raise FetchError('Unsupported content encoding ' + encoding)
+
+class _DeflateDecoder(object):
+  # Servers disagree on whether deflate means zlib wrapped or raw deflate
+  def __init__(self):
+    self.decoder = zlib.decompressobj()
+    self.first = True
+
+  def decompress(self, data, max_length=0):
+    if self.first:
+      self.first = False
+      try:
+        return self.decoder.decompress(data, max_length)
+      except zlib.error:
+        self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self.decoder.decompress(data, max_length)
+
+  def flush(self):
+    return self.decoder.flush()
+
+class HostPool(object):
+  def __init__(self, scheme, netloc, fetcher):
+    self.scheme = scheme
+    self.netloc = netloc
+    self.fetcher = fetcher
+    self.idle = []
+    self.lock = threading.Lock()
+    self.semaphore = threading.BoundedSemaphore(fetcher.max_connections_per_host)
+    self.stats = {'requests': 0, 'errors': 0, 'connections_opened': 0,
+                  'connections_reused': 0, 'bytes_received': 0,
+                  'bytes_decoded': 0, 'seconds': 0.0}
+
+  def _count(self, key, amount=1):
+    with self.lock:
+      self.stats[key] += amount
+
+  def _connect(self):
+    cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+    self._count('connections_opened')
+    return cls(self.netloc, timeout=self.fetcher.connect_timeout)
+
+  def _checkout(self):
+    with self.lock:
+      if self.idle:
+        self.stats['connections_reused'] += 1
+        return self.idle.pop(), True
+    return self._connect(), False
+
+  def _checkin(self, conn):
+    with self.lock:
+      self.idle.append(conn)
+
+  def close(self):
+    with self.lock:
+      idle, self.idle = self.idle, []
+    for conn in idle:
+      conn.close()
+
+  def request(self, method, path, headers, data):
+    self.semaphore.acquire()
+    start = time.monotonic()
+    try:
+      self._count('requests')
+      conn, reused = self._checkout()
+      try:
+        sock, response = self._send(conn, method, path, headers, data, start)
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        # Idle keep-alive connections may have been closed by the server
+        conn.close()
+        if not reused:
+          raise
+        conn = self._connect()
+        sock, response = self._send(conn, method, path, headers, data, start)
+      try:
+        body = self._read_body(sock, response, start)
+      except:
+        conn.close()
+        raise
+      if response.will_close:
+        conn.close()
+      else:
+        sock.settimeout(self.fetcher.connect_timeout)
+        self._checkin(conn)
+      return response, body
+    except:
+      self._count('errors')
+      raise
+    finally:
+      self._count('seconds', time.monotonic() - start)
+      self.semaphore.release()
+
+  def _set_deadline(self, sock, deadline):
+    # The socket timeout only bounds each recv, so shrink it as the deadline
+    # approaches to stop a server trickling bytes from holding us forever
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      raise FetchError('Download timed out')
+    sock.settimeout(min(remaining, self.fetcher.connect_timeout))
+
+  def _send(self, conn, method, path, headers, data, start):
+    conn.request(method, path, body=data, headers=headers)
+    # Keep hold of the socket, http.client drops it from conn for responses
+    # which will close the connection but the response still reads from it
+    sock = conn.sock
+    self._set_deadline(sock, start + self.fetcher.download_timeout)
+    try:
+      return sock, conn.getresponse()
+    except socket.timeout:
+      raise FetchError('Download timed out')
+
+  def _read_body(self, sock, response, start):
+    max_body_size = self.fetcher.max_body_size
+    deadline = start + self.fetcher.download_timeout
+    length = response.getheader('Content-Length')
+    if length and length.isdigit() and int(length) > max_body_size:
+      raise FetchError('Response too large: ' + length + ' bytes')
+    decoder = _make_decoder(response.getheader('Content-Encoding'))
+    chunks = []
+    size = 0
+    while True:
+      self._set_deadline(sock, deadline)
+      try:
+        # read1 returns whatever has arrived rather than waiting for a full chunk
+        chunk = response.read1(CHUNK_SIZE)
+      except socket.timeout:
+        raise FetchError('Download timed out')
+      if not chunk:
+        break
+      self._count('bytes_received', len(chunk))
+      if decoder:
+        # Bound the decompressed output too so small bombs can't blow up
+        chunk = decoder.decompress(chunk, max_body_size - size + 1)
+      size += len(chunk)
+      if size > max_body_size:
+        raise FetchError('Response larger than ' + str(max_body_size) + ' bytes')
+      chunks.append(chunk)
+    response.close()
+    if decoder:
+      chunk = decoder.flush()
+      size += len(chunk)
+      if size > max_body_size:
+        raise FetchError('Response larger than ' + str(max_body_size) + ' bytes')
+      chunks.append(chunk)
+    self._count('bytes_decoded', size)
+    return b''.join(chunks)
+
+class Fetcher(object):
+  def __init__(self, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+               max_body_size=MAX_BODY_SIZE, connect_timeout=CONNECT_TIMEOUT,
+               download_timeout=DOWNLOAD_TIMEOUT, user_agent=USER_AGENT):
+    self.max_connections_per_host = max_connections_per_host
+    self.max_body_size = max_body_size
+    self.connect_timeout = connect_timeout
+    self.download_timeout = download_timeout
+    self.user_agent = user_agent
+    self.pools = {}
+    self.lock = threading.Lock()
+
+  def get_pool(self, scheme, netloc):
+    key = scheme + '://' + netloc
+    with self.lock:
+      if key not in self.pools:
+        self.pools[key] = HostPool(scheme, netloc, self)
+      return self.pools[key]
+
+  def request(self, method, url, headers=None, data=None):
+    all_headers = {'User-Agent': self.user_agent,
+                   'Accept-Encoding': 'gzip, deflate'}
+    all_headers.update(headers or {})
+    for _ in range(MAX_REDIRECTS + 1):
+      p = urllib.parse.urlsplit(url)
+      if p.scheme not in ('http', 'https'):
+        raise FetchError('Unsupported URL scheme ' + repr(p.scheme))
+      path = urllib.parse.urlunsplit(('', '', p.path or '/', p.query, ''))
+      pool = self.get_pool(p.scheme, p.netloc)
+      response, body = pool.request(method, path, all_headers, data)
+      location = response.getheader('Location')
+      if response.status in (301, 302, 303, 307, 308) and location:
+        url = urllib.parse.urljoin(url, location)
+        if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+          method, data = 'GET', None
+        continue
+      response = Response(url, response.status, response.headers, body)
+      if not 200 <= response.status < 300:
+        raise HTTPStatusError(response)
+      return response
+    raise FetchError('Too many redirects')
+
+  def stats(self):
+    with self.lock:
+      pools = list(self.pools.items())
+    result = {}
+    for key, pool in pools:
+      with pool.lock:
+        result[key] = dict(pool.stats, idle_connections=len(pool.idle))
+    return result
+
+  def close(self):
+    with self.lock:
+      pools = list(self.pools.values())
+    for pool in pools:
+      pool.close()
+
+# Shared by the main module and subextensions
+default_fetcher = Fetcher()
+
+def webrequest(method, url, headers=None, data=None):
+  return default_fetcher.request(method, url, headers=headers, data=data)
+
+def stats():
+  return default_fetcher.stats()
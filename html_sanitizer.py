@@ -4,6 +4,7 @@ from urllib.parse import urlparse, urljoin
 ALLOWED_TAGS = ['a', 'img', 'div', 'span', 'i', 'b', 'u', 'br', 'hr', 'p', 'video', 'audio', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'ul']
 ALLOWED_ATTR = ['src', 'href', 'controls', 'style', 'data-srcset', 'data-src', 'alt', 'title']
 BAD_STYLE = ['display', 'border', 'float']
+BLOCK_TAGS = ['br', 'hr', 'p', 'div', 'li', 'ul', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6']
 
 def is_url_absolute(url):
   return not not urlparse(url).netloc
@@ -54,5 +55,27 @@ class Sanitizer(html.parser.HTMLParser):
     for tag in self.tag_stack:
       self.sanitized.append('</'+tag+'>')
 
+class TextExtractor(html.parser.HTMLParser):
+  def __init__(self):
+    self.text = []
+    html.parser.HTMLParser.__init__(self)
+
+  def handle_data(self, data):
+    self.text.append(data)
+
+  def handle_starttag(self, tag, attrs):
+    if tag in BLOCK_TAGS:
+      self.text.append(' ')
+
+  def handle_endtag(self, tag):
+    if tag in BLOCK_TAGS:
+      self.text.append(' ')
+
 def sanitize(htm, link):
   return Sanitizer(link).sanitize(htm)
+
+def to_text(htm):
+  extractor = TextExtractor()
+  extractor.feed(htm)
+  extractor.close()
+  return ' '.join(''.join(extractor.text).split())
@@ -0,0 +1,54 @@
+# Feed ingestion steps which don't touch Sessen or the database
+# Everything here must stay picklable so it can run in a worker process
+
+import hashlib, time, email.utils, html
+import feed_parser, html_sanitizer, dedup
+
+EXCERPT_LENGTH = 280
+
+def sha1(s):
+  try:
+    return hashlib.sha1(s).digest()
+  except TypeError:
+    return hashlib.sha1(s.encode()).digest()
+
+def get_pubdate(item):
+  try:
+    return time.mktime(email.utils.parsedate(item['pubdate']))
+  except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
+    pass
+  try:
+    return time.mktime(time.strptime(item['updated'], '%Y-%m-%dT%H:%M:%S%z'))
+  except (KeyError, TypeError, ValueError, OverflowError, AttributeError):
+    pass
+  if 'pubdate' in item and type(item['pubdate']) is float:
+    return item['pubdate']
+  elif 'pubdate' in item and type(item['pubdate']) is int:
+    return float(item['pubdate'])
+  return time.time()
+
+def make_excerpt(description):
+  text = html_sanitizer.to_text(description)
+  if len(text) > EXCERPT_LENGTH:
+    text = text[:EXCERPT_LENGTH].rsplit(' ', 1)[0] + '...'
+  return text
+
+def prepare_items(subscription, feed, fingerprint=False):
+  # feed is either a parsed feed dict or the raw text of a feed
+  # With fingerprint set, each item tuple is followed by its dedup fingerprint
+  if not isinstance(feed, dict):
+    feed = feed_parser.parse(feed)
+  items = []
+  for item in feed['items']:
+    link = html.unescape(item['link'])
+    guid = sha1(sha1(subscription['url'])+sha1(item['guid']))
+    description = html_sanitizer.sanitize(item['description'], link)
+    pubdate = get_pubdate(item)
+    read = False
+    subscription_rowid = subscription['rowid']
+    excerpt = make_excerpt(description)
+    row = (guid, item['title'], link, description, pubdate, read, subscription_rowid, excerpt)
+    if fingerprint:
+      row += (dedup.fingerprint(link, description),)
+    items.append(row)
+  return items
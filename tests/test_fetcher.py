@@ -0,0 +1,164 @@
+# Exercises fetcher against a local http.server stand-in
+# Runs under pytest or python -m unittest discover -s tests
+
+import gzip, http.server, os, sys, threading, time, unittest, zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fetcher
+
+BODY = b'<rss>' + b'x'*5000 + b'</rss>'
+
+def raw_deflate(data):
+  c = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+  return c.compress(data) + c.flush()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def send_body(self, body, encoding=None, length=None):
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(body) if length is None else length))
+    if encoding:
+      self.send_header('Content-Encoding', encoding)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == '/plain':
+      self.send_body(BODY)
+    elif self.path == '/gzip':
+      self.send_body(gzip.compress(BODY), 'gzip')
+    elif self.path == '/zlib':
+      self.send_body(zlib.compress(BODY), 'deflate')
+    elif self.path == '/raw_deflate':
+      self.send_body(raw_deflate(BODY), 'deflate')
+    elif self.path == '/bomb':
+      self.send_body(gzip.compress(b'\0'*(4*1024*1024)), 'gzip')
+    elif self.path == '/large':
+      self.send_body(b'x'*2000)
+    elif self.path == '/redirect':
+      self.send_response(302)
+      self.send_header('Location', '/gzip')
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    elif self.path == '/stale':
+      # Looks like a keep-alive response but the server hangs up afterwards
+      self.send_body(BODY)
+      self.close_connection = True
+    elif self.path == '/trickle':
+      self.send_response(200)
+      self.send_header('Content-Length', '200')
+      self.end_headers()
+      try:
+        for _ in range(200):
+          self.wfile.write(b'x')
+          self.wfile.flush()
+          time.sleep(0.05)
+      except OSError:
+        pass
+    elif self.path == '/latin1':
+      self.send_body('<?xml version="1.0" encoding="ISO-8859-1"?><rss>caf\xe9</rss>'.encode('latin-1'))
+    elif self.path == '/bom':
+      self.send_body('<rss>caf\xe9</rss>'.encode('utf-16'))
+    elif self.path == '/error':
+      self.send_error(500)
+    else:
+      self.send_error(404)
+
+class FetcherTests(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    cls.server.daemon_threads = True
+    threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+    cls.base = 'http://127.0.0.1:' + str(cls.server.server_port)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+
+  def setUp(self):
+    self.fetcher = fetcher.Fetcher()
+
+  def tearDown(self):
+    self.fetcher.close()
+
+  def get(self, path):
+    return self.fetcher.request('GET', self.base + path)
+
+  def pool_stats(self):
+    return self.fetcher.stats()[self.base]
+
+  def test_keep_alive_reuses_connection(self):
+    for _ in range(3):
+      self.assertEqual(self.get('/plain').data, BODY)
+    stats = self.pool_stats()
+    self.assertEqual(stats['connections_opened'], 1)
+    self.assertEqual(stats['connections_reused'], 2)
+    self.assertEqual(stats['idle_connections'], 1)
+
+  def test_gzip(self):
+    self.assertEqual(self.get('/gzip').data, BODY)
+
+  def test_zlib_deflate(self):
+    self.assertEqual(self.get('/zlib').data, BODY)
+
+  def test_raw_deflate(self):
+    self.assertEqual(self.get('/raw_deflate').data, BODY)
+
+  def test_content_length_cap(self):
+    self.fetcher.max_body_size = 1000
+    with self.assertRaises(fetcher.FetchError):
+      self.get('/large')
+    self.assertEqual(self.pool_stats()['errors'], 1)
+
+  def test_decompressed_size_cap(self):
+    self.fetcher.max_body_size = 1024*1024
+    with self.assertRaises(fetcher.FetchError):
+      self.get('/bomb')
+
+  def test_download_deadline(self):
+    self.fetcher.download_timeout = 1
+    start = time.monotonic()
+    with self.assertRaises(fetcher.FetchError):
+      self.get('/trickle')
+    self.assertLess(time.monotonic() - start, 3)
+
+  def test_redirect(self):
+    r = self.get('/redirect')
+    self.assertEqual(r.status, 200)
+    self.assertEqual(r.url, self.base + '/gzip')
+    self.assertEqual(r.data, BODY)
+
+  def test_xml_declaration_encoding(self):
+    self.assertIn('caf\xe9', self.get('/latin1').text())
+
+  def test_bom_encoding(self):
+    self.assertEqual(self.get('/bom').text(), '<rss>caf\xe9</rss>')
+
+  def test_not_found(self):
+    with self.assertRaises(fetcher.HTTPStatusError) as cm:
+      self.get('/missing')
+    self.assertEqual(cm.exception.response.status, 404)
+
+  def test_server_error(self):
+    with self.assertRaises(fetcher.HTTPStatusError) as cm:
+      self.get('/error')
+    self.assertEqual(cm.exception.response.status, 500)
+
+  def test_retry_after_stale_idle_connection(self):
+    self.assertEqual(self.get('/stale').data, BODY)
+    self.assertEqual(self.pool_stats()['idle_connections'], 1)
+    time.sleep(0.1)
+    self.assertEqual(self.get('/plain').data, BODY)
+    stats = self.pool_stats()
+    self.assertEqual(stats['connections_reused'], 1)
+    self.assertEqual(stats['connections_opened'], 2)
+    self.assertEqual(stats['errors'], 0)
+
+if __name__ == '__main__':
+  unittest.main()